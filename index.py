@@ -1,30 +1,156 @@
 import os, base64, pickle, tempfile, sys
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from bs4 import BeautifulSoup
+import shutil
+import asyncio
+import contextvars
+import hashlib
+import importlib
+import io
+import math
+import mimetypes
+import struct
+import threading
+import zlib
 import time
 import re
-from ollama import chat
-from pydantic import BaseModel
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.chrome.service import Service
-from webdriver_manager.chrome import ChromeDriverManager
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import json
+import statistics
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
 
+# Third-party modules (selenium, ollama, google clients, ...) are imported on
+# first use through lazy_import() so each command only pays for what it needs.
+
 SCOPES = ['https://www.googleapis.com/auth/gmail.modify',
           'https://www.googleapis.com/auth/drive',
           'https://www.googleapis.com/auth/spreadsheets']
 LABEL           = 'GCS/Weekly Timesheet'
 TOKEN_FILE      = 'token.pickle'
 CREDENTIALS_FILE= 'credentials.json'      
+HISTORY_FILE    = 'hours_history.bin'
+SPREADSHEET_ID = "1ejsCfqnt_2-taD_uyTBnjF5u92sBd_RWoSmRkjgkTnE"
 CHROME_BIN = "C:\\Program Files\\Google\\Chrome\\Application\\chrome.exe"
 
-def get_gmail_service():
+RUN_DEADLINE = 600  # seconds for a whole run, override with --deadline=SECONDS
+# Upper bound per stage (seconds), always capped by what is left of the run deadline
+STAGE_BUDGETS = {
+    'api': 30,          # one Google API call
+    'export': 60,       # one Sheets PDF export
+    'screenshot': 90,   # Selenium start, page load and screenshot of one timesheet
+    'hours': 240,       # the whole model cascade for one week
+}
+
+# time.monotonic() value the current run must finish by; set by the command dispatcher
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+def stage_deadline(stage):
+    """Absolute time.monotonic() deadline for a stage starting now: its budget, capped by the run deadline.
+
+    Work it out once when the stage starts and pass it down, so every blocking
+    call inside the stage shares one budget instead of each getting a fresh one.
+    """
+    now = time.monotonic()
+    deadline = now + STAGE_BUDGETS[stage]
+    run_deadline = _deadline.get()
+    if run_deadline is not None:
+        if run_deadline <= now:
+            raise TimeoutError(f"Run deadline exceeded before stage '{stage}'")
+        deadline = min(deadline, run_deadline)
+    return deadline
+
+# Set when one part of a run fails in a way that sinks the whole run (e.g. a week's
+# screenshot), so work running in other threads stops at its next blocking call
+# instead of finishing work whose result will be thrown away
+_run_cancelled = threading.Event()
+
+def time_left(deadline, what):
+    """Seconds the next blocking call may take; raises once the deadline has passed
+    or the run has been cancelled."""
+    if _run_cancelled.is_set():
+        raise TimeoutError(f"Cancelled before {what}: another part of the run failed")
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise TimeoutError(f"Out of time before {what}")
+    return remaining
+
+def run_with_timeout(what, func, timeout, cleanup=None):
+    """Run a blocking call that has no timeout of its own, giving up after `timeout` seconds.
+
+    The call runs in a daemon thread, so an abandoned call can't keep the run
+    (or asyncio.run's executor shutdown) waiting. If it finishes after we gave
+    up, its result is handed to `cleanup`, e.g. to quit a late browser.
+    """
+    lock = threading.Lock()
+    state = {}
+    finished = threading.Event()
+
+    def target():
+        try:
+            outcome = ('value', func())
+        except BaseException as e:
+            outcome = ('error', e)
+        with lock:
+            state['outcome'] = outcome
+            abandoned = state.get('abandoned', False)
+        finished.set()
+        if abandoned and cleanup and outcome[0] == 'value':
+            cleanup(outcome[1])
+
+    threading.Thread(target=target, daemon=True).start()
+    finished.wait(timeout)
+    with lock:
+        if 'outcome' not in state:
+            state['abandoned'] = True
+            raise TimeoutError(f"{what} did not finish within {timeout:.1f} s")
+        kind, result = state['outcome']
+    if kind == 'error':
+        raise result
+    return result
+
+# (label, seconds) pairs collected by timed(); printed with --timings
+TIMINGS = []
+
+@contextmanager
+def timed(label):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        TIMINGS.append((label, time.perf_counter() - start))
+
+def lazy_import(name):
+    """Import a module on first use, recording how long the import took."""
+    if name not in sys.modules:
+        with timed(f"import {name}"):
+            importlib.import_module(name)
+    return sys.modules[name]
+
+# name -> function, filled in by the @command decorator
+COMMANDS = {}
+
+def command(name):
+    def register(func):
+        COMMANDS[name] = func
+        return func
+    return register
+
+def print_timings():
+    print("\nTimings:")
+    for label, seconds in TIMINGS:
+        print(f"  {label:<45} {seconds * 1000:8.1f} ms")
+
+_creds = None
+
+def get_credentials():
+    global _creds
+    if _creds is not None:
+        return _creds
+
     creds = None
     if os.path.exists(TOKEN_FILE):
         with open(TOKEN_FILE, 'rb') as token:
@@ -32,84 +158,112 @@ def get_gmail_service():
 
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
+            # Only a refresh needs requests; a valid cached token skips the import
+            Request = lazy_import('google.auth.transport.requests').Request
             creds.refresh(Request())
         else:
-            flow  = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
+            flow_module = lazy_import('google_auth_oauthlib.flow')
+            flow  = flow_module.InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
             creds = flow.run_local_server(port=0)
         with open(TOKEN_FILE, 'wb') as token:
             pickle.dump(creds, token)
 
-    return build('gmail', 'v1', credentials=creds)
+    _creds = creds
+    return creds
+
+SERVICE_VERSIONS = {'gmail': 'v1', 'sheets': 'v4', 'drive': 'v3'}
+_services = {}
+
+def get_service(name):
+    """Build a Google API client the first time a command asks for it."""
+    if name not in _services:
+        build = lazy_import('googleapiclient.discovery').build
+        creds = get_credentials()
+        with timed(f"init {name} service"):
+            _services[name] = build(name, SERVICE_VERSIONS[name], credentials=creds)
+    return _services[name]
+
+def get_gmail_service():
+    return get_service('gmail')
 
 def get_sheets_service():
-    creds = None
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'rb') as token:
-            creds = pickle.load(token)
-            
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow  = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
-            
-    return build('sheets', 'v4', credentials=creds)
+    return get_service('sheets')
 
 def get_drive_service():
-    creds = None
-    if os.path.exists(TOKEN_FILE):
-        with open(TOKEN_FILE, 'rb') as token:
-            creds = pickle.load(token)
+    return get_service('drive')
 
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow  = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_FILE, SCOPES)
-            creds = flow.run_local_server(port=0)
+_http_local = threading.local()
 
-    return build('drive', 'v3', credentials=creds)
+def authorized_http(timeout):
+    """Authorised transport for the calling thread, with `timeout` as its socket timeout.
 
-gmail_service = get_gmail_service()
-sheets_service = get_sheets_service()
-drive_service = get_drive_service()
-  
-def latest_summary_threads(max_threads=2):
-    lbls = gmail_service.users().labels().list(userId='me').execute()['labels']
+    httplib2 connections can't be shared across threads, so each worker thread keeps
+    its own and reuses its open connections (no new TCP+TLS handshake per call)."""
+    http = getattr(_http_local, 'http', None)
+    if http is None:
+        httplib2 = lazy_import('httplib2')
+        AuthorizedHttp = lazy_import('google_auth_httplib2').AuthorizedHttp
+        http = _http_local.http = AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=timeout))
+    # The time left differs per call: apply it to new and already-open connections alike
+    http.http.timeout = timeout
+    for conn in http.http.connections.values():
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+    return http
+
+async def aexecute(request):
+    """Execute a googleapiclient request in a worker thread so independent calls overlap."""
+    # The socket timeout bounds the worker thread itself; asyncio can't cancel threads
+    timeout = time_left(stage_deadline('api'), "API call")
+    return await asyncio.to_thread(lambda: request.execute(http=authorized_http(timeout)))
+
+async def arequest(url):
+    """Authorised raw GET (e.g. the Sheets PDF export) in a worker thread."""
+    timeout = time_left(stage_deadline('export'), "PDF export")
+    return await asyncio.to_thread(lambda: authorized_http(timeout).request(url))
+
+async def latest_summary_threads(max_threads=2):
+    lbls = (await aexecute(get_gmail_service().users().labels().list(userId='me')))['labels']
     label_id = next((l['id'] for l in lbls if l['name'] == LABEL), None)
     if not label_id:
         print(f"[!] Gmail label \"{LABEL}\" not found"); return []
 
-    threads = gmail_service.users().threads().list(
+    threads = (await aexecute(get_gmail_service().users().threads().list(
                 userId='me', labelIds=[label_id], maxResults=max_threads
-              ).execute().get('threads', [])
+              ))).get('threads', [])
     return [t['id'] for t in threads]
 
-def get_thread_html(thread_id):
-    """Return the first HTML part of the first message in the thread."""
-    thread = gmail_service.users().threads().get(
-               userId='me', id=thread_id, format='full'
-             ).execute()
-    msg = thread['messages'][0]['payload']
-    # multipart: look for a part with mimeType == text/html
-    if 'parts' in msg:
-        for p in msg['parts']:
-            if p.get('mimeType') == 'text/html' and 'data' in p['body']:
-                return base64.urlsafe_b64decode(p['body']['data']).decode()
-    # single-part fallback
-    if msg.get('mimeType') == 'text/html' and 'data' in msg['body']:
-        return base64.urlsafe_b64decode(msg['body']['data']).decode()
+async def first_message_id(thread_id):
+    """Return the id of the first message in a thread without downloading any bodies."""
+    thread = await aexecute(get_gmail_service().users().threads().get(
+               userId='me', id=thread_id, format='minimal', fields='messages/id'
+             ))
+    return thread['messages'][0]['id']
+
+def find_part(payload, mime_type):
+    """Depth-first search of a MIME tree (nested multipart/* included) for the first part of mime_type."""
+    if payload.get('mimeType') == mime_type and payload.get('body', {}).get('size', 0) > 0:
+        return payload
+    for part in payload.get('parts', []):
+        found = find_part(part, mime_type)
+        if found:
+            return found
     return None
 
-def get_thread_subject(thread_id):
-    """Get the subject of the first message in the thread."""
-    thread = gmail_service.users().threads().get(
-               userId='me', id=thread_id, format='metadata'
-             ).execute()
-    
-    # Find subject in headers
-    headers = thread['messages'][0]['payload']['headers']
+async def get_part_data(message_id, part):
+    """Decode a part body, fetching it by attachmentId only when Gmail didn't inline it."""
+    body = part['body']
+    data = body.get('data')
+    if data is None and 'attachmentId' in body:
+        data = (await aexecute(get_gmail_service().users().messages().attachments().get(
+                 userId='me', messageId=message_id, id=body['attachmentId'], fields='data'
+               )))['data']
+    return base64.urlsafe_b64decode(data) if data else None
+
+def subject_from_headers(payload, thread_id):
+    """Get the subject from the message headers, made safe for use as a filename."""
+    headers = payload.get('headers', [])
     subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), None)
     
     # Clean up subject for filename
@@ -122,6 +276,24 @@ def get_thread_subject(thread_id):
     
     return f"timesheet_{thread_id}"  # Fallback if no subject found
 
+async def get_thread_email(thread_id):
+    """Return (subject, first HTML part) of the first message in the thread."""
+    message_id = await first_message_id(thread_id)
+    # One request for both the Subject header and the MIME tree of that message only
+    msg = await aexecute(get_gmail_service().users().messages().get(
+            userId='me', id=message_id, format='full',
+            fields='payload(mimeType,headers,body,parts)'
+          ))
+    payload = msg['payload']
+    subject = subject_from_headers(payload, thread_id)
+
+    part = find_part(payload, 'text/html')
+    if not part:
+        return subject, None
+
+    data = await get_part_data(message_id, part)
+    return subject, data.decode() if data else None
+
 def extract_header_and_body(full_html: str) -> str:
     """
     Return a stand-alone HTML string containing everything from
@@ -140,6 +312,7 @@ def extract_header_and_body(full_html: str) -> str:
     section_html = full_html[start_idx : end_idx + len(end_marker)]
 
     # pull in any global <style> blocks so your CSS still works
+    BeautifulSoup = lazy_import('bs4').BeautifulSoup
     soup = BeautifulSoup(full_html, 'html.parser')
     style_blocks = ''.join(str(tag) for tag in soup.find_all('style'))
 
@@ -161,8 +334,18 @@ def extract_header_and_body(full_html: str) -> str:
   </body>
 </html>"""
 
-def html_to_png(html, folder_name, filename):
+def install_chromedriver(deadline):
+    """Download (or reuse the cached) chromedriver; call once per run, not per screenshot."""
+    ChromeDriverManager = lazy_import('webdriver_manager.chrome').ChromeDriverManager
+    return run_with_timeout("chromedriver install", lambda: ChromeDriverManager().install(),
+                            time_left(deadline, "chromedriver install"))
+
+def html_to_png(html, folder_name, filename, driver_path, deadline):
+    temp_path = None
+    driver = None
     try:
+        time_left(deadline, "screenshot")  # fail fast if the stage is already out of time
+
         # Extract only the relevant section
         table_only = extract_header_and_body(html)        
 
@@ -177,26 +360,45 @@ def html_to_png(html, folder_name, filename):
         # Take screenshot with Selenium
         try:
             print(f"[i] Attempting screenshot with Selenium")
+            webdriver = lazy_import('selenium.webdriver')
+            Options = lazy_import('selenium.webdriver.chrome.options').Options
+            Service = lazy_import('selenium.webdriver.chrome.service').Service
+            WebDriverWait = lazy_import('selenium.webdriver.support.ui').WebDriverWait
+            SeleniumTimeout = lazy_import('selenium.common.exceptions').TimeoutException
+
             chrome_options = Options()
             chrome_options.add_argument("--headless=new")
             chrome_options.add_argument("--window-size=700,1100")
             chrome_options.add_argument("--no-sandbox")
             chrome_options.binary_location = CHROME_BIN
             
-            service = Service(ChromeDriverManager().install())
-            driver = webdriver.Chrome(service=service, options=chrome_options)
+            service = Service(driver_path)
+            # Browser startup has no timeout of its own; a browser that starts too late is quit
+            driver = run_with_timeout(
+                "Chrome startup",
+                lambda: webdriver.Chrome(service=service, options=chrome_options),
+                time_left(deadline, "Chrome startup"),
+                cleanup=lambda late_driver: late_driver.quit(),
+            )
             
-            file_url = f"file:///{temp_path.replace('\\', '/')}"
+            file_url = "file:///" + temp_path.replace('\\', '/')
             print(f"[i] Loading URL: {file_url}")
-            driver.get(file_url)
-            
-            # Wait for page to load
-            time.sleep(2)
+            try:
+                driver.set_page_load_timeout(time_left(deadline, "page load"))
+                driver.get(file_url)
+                
+                # Wait until the page and its fonts have rendered, but no longer than the budget
+                WebDriverWait(driver, time_left(deadline, "page render")).until(
+                    lambda d: d.execute_script(
+                        "return document.readyState === 'complete' && document.fonts.status === 'loaded'"
+                    )
+                )
+            except SeleniumTimeout as e:
+                raise TimeoutError(f"Timesheet page did not render in time: {e.msg}") from e
             
             # Take screenshot
             print(f"[i] Taking screenshot and saving to: {result_path}")
             driver.save_screenshot(result_path)
-            driver.quit()
             
             # Check if screenshot was created
             if os.path.exists(result_path):
@@ -210,10 +412,6 @@ def html_to_png(html, folder_name, filename):
             print(traceback.format_exc())
             raise
         
-        # Clean up the temp file
-        os.unlink(temp_path)
-        print(f"[i] Removed temp file: {temp_path}")
-        
         return result_path
     except Exception as e:
         print(f"[!] Detailed error in html_to_png: {str(e)}")
@@ -221,10 +419,20 @@ def html_to_png(html, folder_name, filename):
         import traceback
         print(traceback.format_exc())
         raise
+    finally:
+        # Always release the browser and the temp file, including on timeouts
+        if driver is not None:
+            driver.quit()
+        if temp_path and os.path.exists(temp_path):
+            os.unlink(temp_path)
+            print(f"[i] Removed temp file: {temp_path}")
     
-def duplicate_invoice_tab(spreadsheet_id):
+async def plan_invoice_tab(spreadsheet_id):
+    """Work out the next invoice tab (title, sheetId, source tab) without writing anything."""
     # 1) read all sheets
-    meta = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+    meta = await aexecute(get_sheets_service().spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields='sheets.properties(sheetId,title)'
+    ))
     sheet_list = meta.get('sheets', [])
 
     # 2) pick the highest invoice no from tab titles
@@ -244,134 +452,247 @@ def duplicate_invoice_tab(spreadsheet_id):
         raise ValueError("No sheets with 'Invoice #' found.")
 
     latest = max(invoice_sheets, key=lambda sh: extract_invoice_number(sh['properties']['title']))
-    old_id   = latest['properties']['sheetId']
     old_title= latest['properties']['title']
     next_num = extract_invoice_number(old_title) + 1
-    new_title= f"Invoice #{next_num}"
 
-    # 3) duplicate via batchUpdate
-    body = {
-      'requests': [{
-        'duplicateSheet': {
-          'sourceSheetId': old_id,
-          'insertSheetIndex': len(sheet_list),  # Ensure the new sheet is added at the end
-          'newSheetName': new_title
-        }
-      }]
+    return {
+        'source_sheet_id': latest['properties']['sheetId'],
+        'source_title': old_title,
+        # Choose the new sheetId up front so the cell updates can target it in the same batch
+        'sheet_id': max(s['properties']['sheetId'] for s in sheet_list) + 1,
+        'title': f"Invoice #{next_num}",
+        'index': len(sheet_list),  # Ensure the new sheet is added at the end
     }
-    response = sheets_service.spreadsheets().batchUpdate(
-        spreadsheetId=spreadsheet_id, body=body).execute()
 
-    # Check if the duplication was successful
-    if 'replies' in response and response['replies']:
-        print(f"Duplicated sheet '{old_title}' as '{new_title}'")
-    else:
-        raise RuntimeError("Failed to duplicate the sheet.")
+# data key -> (top-left cell of the merged range, value formatter)
+INVOICE_CELLS = {
+    'invoice_no':      ('F12', lambda v: f"#{v}"),                         # F12:G12
+    'submission_date': ('B9',  lambda v: f"Submitted on {v} (GMT+8)"),     # B9:C9
+    'week_one_date':   ('B19', str),                                       # B19:D19
+    'week_two_date':   ('B20', str),                                       # B20:D20
+    'week_one_hours':  ('E19', float),
+    'week_two_hours':  ('E20', float),
+}
 
-    return new_title
+def a1_to_grid(sheet_id, cell):
+    """Convert a single A1 cell such as 'F12' into a one-cell GridRange."""
+    match = re.fullmatch(r'([A-Z]+)(\d+)', cell)
+    column = 0
+    for letter in match.group(1):
+        column = column * 26 + ord(letter) - ord('A') + 1
+    row = int(match.group(2))
+    return {
+        'sheetId': sheet_id,
+        'startRowIndex': row - 1, 'endRowIndex': row,
+        'startColumnIndex': column - 1, 'endColumnIndex': column,
+    }
 
-def set_sheet_data(spreadsheet_id, sheet_name, data):
-    # Get the sheet ID
-    sheet_id = None
-    for sheet in sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute().get('sheets', []):
-        if sheet['properties']['title'] == sheet_name:
-            sheet_id = sheet['properties']['sheetId']
-            break
-    
-    if not sheet_id:
-        raise ValueError(f"Sheet '{sheet_name}' not found in spreadsheet '{spreadsheet_id}'")
-    
-    # Process the data updates
+def sheet_data_requests(sheet_id, data):
     # Expected data format: {
     #   'invoice_no': str,
     #   'submission_date': str,  # format: MM/DD/YYYY
     #   'week_one_date': str,
     #   'week_two_date': str,
-    #   'week_one_hours': int,
-    #   'week_two_hours': int
+    #   'week_one_hours': float,
+    #   'week_two_hours': float
     # }
-    
-  
-    # Update values using batchUpdate with valueInputOption=USER_ENTERED
-    value_ranges = []
-    
-    # F12:G12 -> #[invoice_no]
-    if 'invoice_no' in data:
-        value_ranges.append({
-            'range': f"'{sheet_name}'!F12:G12",
-            'values': [[f"#{data['invoice_no']}"]]
-        })
-    
-    # B9:C9 -> Submitted on [MM/DD/YYYY] (GMT+8)
-    if 'submission_date' in data:
-        value_ranges.append({
-            'range': f"'{sheet_name}'!B9:C9",
-            'values': [[f"Submitted on {data['submission_date']} (GMT+8)"]]
-        })
-    
-    # B19:D19 -> [week_one_date]
-    if 'week_one_date' in data:
-        value_ranges.append({
-            'range': f"'{sheet_name}'!B19:D19",
-            'values': [[data['week_one_date']]]
-        })
-    
-    # B20:D20 -> [week_two_date]
-    if 'week_two_date' in data:
-        value_ranges.append({
-            'range': f"'{sheet_name}'!B20:D20",
-            'values': [[data['week_two_date']]]
-        })
-
-    # E19 -> [week_one_hours]
-    if 'week_one_hours' in data:
-        value_ranges.append({
-            'range': f"'{sheet_name}'!E19",
-            'values': [[data['week_one_hours']]]
+    requests = []
+    for key, (cell, fmt) in INVOICE_CELLS.items():
+        if key not in data:
+            continue
+        value = fmt(data[key])
+        user_value = {'numberValue': value} if isinstance(value, float) else {'stringValue': value}
+        requests.append({
+            'updateCells': {
+                'range': a1_to_grid(sheet_id, cell),
+                'rows': [{'values': [{'userEnteredValue': user_value}]}],
+                'fields': 'userEnteredValue',
+            }
         })
+    return requests
 
-    # E20 -> [week_two_hours]
-    if 'week_two_hours' in data:
-        value_ranges.append({
-            'range': f"'{sheet_name}'!E20",
-            'values': [[data['week_two_hours']]]
-        })
-    
-    # Execute the batch update if there are any value ranges to update
-    if value_ranges:
-        body = {
-            'valueInputOption': 'USER_ENTERED',
-            'data': value_ranges
+async def duplicate_invoice_tab(spreadsheet_id, tab, data):
+    """Create the planned invoice tab and fill in its cells in a single atomic batchUpdate."""
+    body = {
+      'requests': [{
+        'duplicateSheet': {
+          'sourceSheetId': tab['source_sheet_id'],
+          'insertSheetIndex': tab['index'],
+          'newSheetId': tab['sheet_id'],
+          'newSheetName': tab['title']
         }
-        sheets_service.spreadsheets().values().batchUpdate(
-            spreadsheetId=spreadsheet_id,
-            body=body
-        ).execute()
-        
-    return sheet_id
+      }] + sheet_data_requests(tab['sheet_id'], data)
+    }
+    # batchUpdate is all-or-nothing, so a failure never leaves a half-filled tab behind
+    response = await aexecute(get_sheets_service().spreadsheets().batchUpdate(
+        spreadsheetId=spreadsheet_id, body=body))
+
+    # Check if the duplication was successful
+    if 'replies' in response and response['replies']:
+        print(f"Duplicated sheet '{tab['source_title']}' as '{tab['title']}'")
+    else:
+        raise RuntimeError("Failed to duplicate the sheet.")
+
+    return tab['sheet_id']
+
+def get_total_hours(image_path, model='llama3.2-vision', deadline=None):
+    """Ask a vision model for the week's total hours and the per-day hours it adds up from."""
+    BaseModel = lazy_import('pydantic').BaseModel
+    Client = lazy_import('ollama').Client
+    HttpTimeout = lazy_import('httpx').TimeoutException
 
-def get_total_hours(image_path):
     class TotalHours(BaseModel):
       total_hours: float
+      daily_hours: list[float]
     
-    response = chat(
-      messages=[
-        {
-          'role': 'user',
-          'content': 'Please extract the exact total hours from the image. Do not round, keep any decimal places.',
-          'images': [image_path]
-        }
-      ],
-      model='llama3.2-vision',
-      format=TotalHours.model_json_schema(),
-    )
-    
-    total_hours = TotalHours.model_validate_json(response.message.content)
-    return total_hours.total_hours
+    timeout = time_left(deadline, f"{model} call") if deadline is not None else None
+    try:
+      response = Client(timeout=timeout).chat(
+        messages=[
+          {
+            'role': 'user',
+            'content': 'Please extract the exact total hours from the image, and the hours for each day listed. '
+                       'Do not round, keep any decimal places.',
+            'images': [image_path]
+          }
+        ],
+        model=model,
+        format=TotalHours.model_json_schema(),
+      )
+    except HttpTimeout as e:
+      raise TimeoutError(f"{model} did not answer in time") from e
+    
+    return TotalHours.model_validate_json(response.message.content)
+
+# Cheapest tier first; the next tier only runs when validate_hours() rejects an answer
+HOURS_CASCADE = [
+    {'model': 'granite3.2-vision', 'samples': 2},
+    {'model': 'llama3.2-vision',   'samples': 1},
+]
+MAX_WEEKLY_HOURS   = 80.0
+HOURS_TOLERANCE    = 0.05
+CASCADE_STATS_FILE = 'cascade_stats.json'
+_cascade_stats_lock = threading.Lock()
+
+def validate_hours(samples):
+    """Return why the samples can't be trusted, or None if they pass every check."""
+    for sample in samples:
+        if not 0 < sample.total_hours <= MAX_WEEKLY_HOURS:
+            return f"total {sample.total_hours} outside (0, {MAX_WEEKLY_HOURS}]"
+        if not sample.daily_hours:
+            return "no per-day hours to check the total against"
+        if abs(sum(sample.daily_hours) - sample.total_hours) > HOURS_TOLERANCE:
+            return f"daily hours sum to {sum(sample.daily_hours)}, not {sample.total_hours}"
+    totals = [sample.total_hours for sample in samples]
+    if max(totals) - min(totals) > HOURS_TOLERANCE:
+        return f"samples disagree: {totals}"
+    return None
+
+# What happened to a tier's answer: accepted, escalated to the next tier,
+# rejected by the last tier (nothing left to escalate to), or out of time
+CASCADE_OUTCOMES = ('accepted', 'escalated', 'rejected', 'timeouts')
+
+def record_cascade_stats(model, seconds, outcome):
+    """Accumulate per-tier call count, latency and outcome counts across runs."""
+    with _cascade_stats_lock:
+        stats = {}
+        if os.path.exists(CASCADE_STATS_FILE):
+            with open(CASCADE_STATS_FILE) as f:
+                stats = json.load(f)
+        tier = stats.setdefault(model, {'calls': 0, 'seconds': 0.0})
+        tier['calls'] += 1
+        tier['seconds'] += seconds
+        tier[outcome] = tier.get(outcome, 0) + 1
+        with open(CASCADE_STATS_FILE, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+def extract_hours(image_path, deadline):
+    """Run the model cascade and return (total hours, source that produced them).
+
+    If even the last tier fails validation, its answer is still better than a
+    guess: it is returned with the source marked ':unvalidated' as long as the
+    total is within range.
+    """
+    samples = None
+    for n, tier in enumerate(HOURS_CASCADE):
+        model = tier['model']
+        last_tier = n == len(HOURS_CASCADE) - 1
+        start = time.perf_counter()
+        samples = None
+        time_left(deadline, f"{model} tier")  # stop here if out of time or cancelled
+        try:
+            with timed(f"hours {model} {os.path.basename(image_path)}"):
+                # Repeated samples are independent, so ask for them at the same time
+                with ThreadPoolExecutor(max_workers=tier['samples']) as pool:
+                    samples = list(pool.map(lambda _: get_total_hours(image_path, model, deadline),
+                                            range(tier['samples'])))
+            problem = validate_hours(samples)
+        except TimeoutError:
+            # Out of time is not a bad answer: escalating can't help, so report it
+            record_cascade_stats(model, time.perf_counter() - start, 'timeouts')
+            raise
+        except Exception as e:
+            problem = f"{type(e).__name__}: {str(e)}"
+
+        if problem is None:
+            outcome = 'accepted'
+        else:
+            outcome = 'rejected' if last_tier else 'escalated'
+        record_cascade_stats(model, time.perf_counter() - start, outcome)
+
+        if problem is None:
+            return samples[0].total_hours, model
+        print(f"[i] {model} rejected for {os.path.basename(image_path)}: {problem}")
+
+    if samples and 0 < samples[0].total_hours <= MAX_WEEKLY_HOURS:
+        print(f"[!] Using unvalidated {samples[0].total_hours} hours from {model} for {os.path.basename(image_path)}")
+        return samples[0].total_hours, f"{model}:unvalidated"
+
+    raise ValueError("No model in the cascade produced usable hours")
+
+def export_meta_path(filename):
+    """Sidecar next to an exported PDF recording what it was exported from."""
+    return f"{filename}.export.json"
+
+def load_export_meta(filename):
+    if not (os.path.exists(filename) and os.path.exists(export_meta_path(filename))):
+        return None
+    with open(export_meta_path(filename)) as f:
+        return json.load(f)
+
+def save_export_meta(filename, meta):
+    with open(export_meta_path(filename), 'w') as f:
+        json.dump(meta, f, indent=2)
 
-def save_pdf_to_sheet(spreadsheet_id, sheet_name=None, filename=None):
-    # Get all sheets
-    sheets_metadata = sheets_service.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
+async def save_pdf_to_sheet(spreadsheet_id, sheet_name=None, filename=None):
+    def fetch_revision():
+        return aexecute(get_drive_service().files().get(
+            fileId=spreadsheet_id, fields='modifiedTime,version'
+        ))
+
+    # Check the spreadsheet revision first: if nothing changed since the last
+    # export of this file, the existing PDF is still current. Without a cached
+    # export there is nothing to compare against, so don't spend a request on it
+    cached_filename = filename or (f"{sheet_name}.pdf" if sheet_name else None)
+    cached = load_export_meta(cached_filename) if cached_filename else None
+    revision = await fetch_revision() if cached else None
+    if (cached and cached['spreadsheet_id'] == spreadsheet_id
+            and sheet_name in (None, cached['sheet_name'])
+            and cached['version'] == revision['version']
+            and cached['modified_time'] == revision['modifiedTime']):
+        print(f"PDF up to date, skipping export: {cached_filename}")
+        return cached_filename
+
+    # Get all sheets. The revision recorded with an export must be read before the
+    # export starts, or an edit in between would be cached as already exported, so
+    # without one yet fetch it alongside the sheet list
+    sheets_request = aexecute(get_sheets_service().spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields='sheets.properties(sheetId,title)'
+    ))
+    if revision is None:
+        sheets_metadata, revision = await asyncio.gather(sheets_request, fetch_revision())
+    else:
+        sheets_metadata = await sheets_request
     sheet_list = sheets_metadata.get('sheets', [])
     
     # If no sheet name provided, use the last sheet
@@ -395,6 +716,22 @@ def save_pdf_to_sheet(spreadsheet_id, sheet_name=None, filename=None):
     if filename is None:
         filename = f"{sheet_name}.pdf"
     
+    async def fetch_values_hash():
+        tab_values = await aexecute(get_sheets_service().spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id, range=f"'{sheet_name}'"
+        ))
+        return hashlib.sha256(json.dumps(tab_values.get('values', [])).encode()).hexdigest()
+
+    def export_meta(revision, values_hash):
+        return {
+            'spreadsheet_id': spreadsheet_id,
+            'sheet_name': sheet_name,
+            'sheet_id': sheet_id,
+            'version': revision['version'],
+            'modified_time': revision['modifiedTime'],
+            'values_hash': values_hash,
+        }
+
     # Export the PDF using the correct approach for a single sheet
     # Using the sheets.spreadsheets.export endpoint with gid parameter
     # Construct the export URL manually to ensure only the specific sheet is exported    
@@ -418,11 +755,23 @@ def save_pdf_to_sheet(spreadsheet_id, sheet_name=None, filename=None):
     query_params = '&'.join([f"{k}={v}" for k, v in params.items()])
     export_url = f"{export_url}?{query_params}"
     
-    # Use the built-in HTTP client from drive service
-    http = drive_service._http
-    
-    # Make the request
-    response, content = http.request(export_url)
+    cached = load_export_meta(filename)
+    if cached:
+        # The spreadsheet changed, but maybe not this tab: compare a hash of its values
+        values_hash = await fetch_values_hash()
+        meta = export_meta(revision, values_hash)
+        if cached['sheet_id'] == sheet_id and cached['values_hash'] == values_hash:
+            save_export_meta(filename, meta)
+            print(f"PDF tab unchanged, skipping export: {filename}")
+            return filename
+
+        # Make the request with the same authorised transport the API clients use
+        response, content = await arequest(export_url)
+    else:
+        # Nothing cached (e.g. a tab created moments ago): export straight away and
+        # hash the tab's values alongside it
+        (response, content), values_hash = await asyncio.gather(arequest(export_url), fetch_values_hash())
+        meta = export_meta(revision, values_hash)
     
     # Check if the request was successful
     if response.status != 200:
@@ -431,11 +780,119 @@ def save_pdf_to_sheet(spreadsheet_id, sheet_name=None, filename=None):
     # Save the content to a file
     with open(filename, 'wb') as f:
         f.write(content)
+    save_export_meta(filename, meta)
     
     print(f"PDF saved successfully: {filename}")
     return filename
 
-def create_email_draft(invoice_no, date_range, pdf_path, timesheet_images):
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Ancillary PNG chunks that carry metadata only and never affect the pixels
+PNG_METADATA_CHUNKS = {b'tEXt', b'zTXt', b'iTXt', b'tIME', b'eXIf'}
+
+def png_chunk(ctype, body):
+    return struct.pack('>I', len(body)) + ctype + body + struct.pack('>I', zlib.crc32(ctype + body))
+
+def recompress_png(data):
+    """Losslessly re-deflate the image data at max compression and drop metadata chunks."""
+    if not data.startswith(PNG_SIGNATURE):
+        return data
+
+    chunks, idat = [], []
+    pos = len(PNG_SIGNATURE)
+    while pos < len(data):
+        length, ctype = struct.unpack('>I4s', data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        pos += length + 12
+        if ctype == b'IDAT':
+            if not idat:
+                chunks.append((ctype, None))  # placeholder, filled below
+            idat.append(body)
+        elif ctype not in PNG_METADATA_CHUNKS:
+            chunks.append((ctype, body))
+
+    pixels = zlib.decompress(b''.join(idat))
+    packed = zlib.compress(pixels, 9)
+    return PNG_SIGNATURE + b''.join(
+        png_chunk(ctype, packed if body is None else body) for ctype, body in chunks
+    )
+
+def palettize_png(data):
+    """Re-encode as an optimised (palette if <= 256 colours) PNG with Pillow, if installed."""
+    try:
+        Image = lazy_import('PIL.Image')
+    except ImportError:
+        return data
+
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    if img.mode == 'RGBA' and img.getchannel('A').getextrema() == (255, 255):
+        img = img.convert('RGB')  # Chrome screenshots are fully opaque
+
+    colors = img.getcolors(256) if img.mode == 'RGB' else None
+    if colors:
+        # With as many palette slots as colours, the adaptive quantiser should keep
+        # every colour; only use the result if it round-trips exactly
+        paletted = img.convert('P', palette=Image.Palette.ADAPTIVE, colors=len(colors))
+        if paletted.convert('RGB').tobytes() == img.tobytes():
+            img = paletted
+
+    buf = io.BytesIO()
+    img.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+def optimise_pdf(data):
+    """Deduplicate identical objects (fonts, images) and compress page streams with pypdf, if installed."""
+    try:
+        pypdf = lazy_import('pypdf')
+    except ImportError:
+        return data
+
+    writer = pypdf.PdfWriter(clone_from=io.BytesIO(data))
+    for page in writer.pages:
+        page.compress_content_streams()
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+    buf = io.BytesIO()
+    writer.write(buf)
+    return buf.getvalue()
+
+def optimise_attachment(path):
+    """Return (bytes, bytes_saved) for the smallest lossless encoding of the file."""
+    with open(path, 'rb') as f:
+        original = f.read()
+
+    ext = os.path.splitext(path)[1].lower()
+    optimisers = {
+        '.png': [recompress_png, palettize_png],
+        '.pdf': [optimise_pdf],
+    }.get(ext, [])
+
+    best = original
+    for optimise in optimisers:
+        try:
+            candidate = optimise(original)
+        except Exception as e:
+            print(f"[!] {optimise.__name__} failed for {os.path.basename(path)}: {str(e)}")
+            continue
+        if len(candidate) < len(best):
+            best = candidate
+
+    return best, len(original) - len(best)
+
+def attachment_part(path):
+    """Build a MIME part for an optimised copy of the file with its proper MIME type; return (part, bytes saved)."""
+    data, saved = optimise_attachment(path)
+
+    mime_type, _ = mimetypes.guess_type(path)
+    maintype, subtype = (mime_type or 'application/octet-stream').split('/', 1)
+
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(data)
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(path))
+    return part, saved
+
+async def create_email_draft(invoice_no, date_range, pdf_path, timesheet_images):
     """Create an email draft with invoice PDF and timesheet screenshots as attachments."""
     
     # Email details
@@ -464,36 +921,20 @@ Mj Carnaje"""
     # Add body to email
     message.attach(MIMEText(body, 'plain'))
     
-    # Attach PDF
-    if os.path.exists(pdf_path):
-        with open(pdf_path, "rb") as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-        
-        encoders.encode_base64(part)
-        part.add_header(
-            'Content-Disposition',
-            f'attachment; filename= {os.path.basename(pdf_path)}'
-        )
-        message.attach(part)
-        print(f"Attached PDF: {os.path.basename(pdf_path)}")
-    
-    # Attach timesheet images (limit to 2 most recent)
+    # PDF first, then timesheet images (limit to 2 most recent)
     image_list = list(timesheet_images.values())[-2:]  # Get last 2 images
-    for image_path in image_list:
-        if os.path.exists(image_path):
-            with open(image_path, "rb") as attachment:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(attachment.read())
-            
-            encoders.encode_base64(part)
-            part.add_header(
-                'Content-Disposition',
-                f'attachment; filename= {os.path.basename(image_path)}'
-            )
-            message.attach(part)
-            print(f"Attached timesheet: {os.path.basename(image_path)}")
+    paths = [p for p in [pdf_path] + image_list if os.path.exists(p)]
+
+    # Optimise all attachments in parallel worker threads, then attach in order
+    results = await asyncio.gather(*(asyncio.to_thread(attachment_part, p) for p in paths))
+    for path, (part, _) in zip(paths, results):
+        message.attach(part)
+        kind = "PDF" if path == pdf_path else "timesheet"
+        print(f"Attached {kind}: {os.path.basename(path)}")
     
+    bytes_saved = sum(saved for _, saved in results)
+    print(f"Attachment optimisation saved {bytes_saved / 1024:.1f} KB")
+
     # Convert to base64 encoded string
     raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
     
@@ -505,10 +946,10 @@ Mj Carnaje"""
     }
     
     try:
-        draft = gmail_service.users().drafts().create(
+        draft = await aexecute(get_gmail_service().users().drafts().create(
             userId='me',
             body=draft_body
-        ).execute()
+        ))
         
         draft_id = draft['id']
         print(f"Email draft created successfully! Draft ID: {draft_id}")
@@ -521,56 +962,225 @@ Mj Carnaje"""
         print(f"Error creating email draft: {str(e)}")
         return None
 
-def main():
+def month_to_num(month_abbr):
+    months = {
+        'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+        'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
+    }
+    return months.get(month_abbr, 0)
+
+def parse_week_range(week_range, year):
+    """Turn "Apr 11 - 17" or "Apr 25 - May 1" into (start date, end date)."""
+    start_part, end_part = week_range.split(" - ")
+    start_month, start_day = start_part.split()
+    if " " in end_part:
+        end_month, end_day = end_part.split()
+    else:
+        end_month, end_day = start_month, end_part
+
+    start = date(year, month_to_num(start_month), int(start_day))
+    end_year = year + 1 if month_to_num(end_month) < start.month else year  # Dec -> Jan
+    return start, date(end_year, month_to_num(end_month), int(end_day))
+
+def infer_week_dates(week_range, today):
+    """(start, end) of a past timesheet week. Subjects carry no year, so use the latest
+    year in which the week had already started by `today` (handles Dec -> Jan rollover)."""
+    start, end = parse_week_range(week_range, today.year)
+    if start > today:
+        start, end = parse_week_range(week_range, today.year - 1)
+    return start, end
+
+HISTORY_MAGIC = b'HRS1'
+# column name -> array typecode; dates are stored as date.toordinal()
+HISTORY_COLUMNS = {
+    'week_start': 'i',
+    'week_end':   'i',
+    'hours':      'd',
+    'invoice_no': 'i',
+    'source':     'B',  # index into history['sources']
+}
+
+def empty_history():
+    return {
+        'sources': [],
+        'columns': {name: array(code) for name, code in HISTORY_COLUMNS.items()},
+    }
+
+def load_history(path=HISTORY_FILE):
+    """Load the columnar hours history: a JSON header followed by one packed array per column."""
+    history = empty_history()
+    if not os.path.exists(path):
+        return history
+
+    with open(path, 'rb') as f:
+        if f.read(4) != HISTORY_MAGIC:
+            raise ValueError(f"'{path}' is not an hours history file")
+        header_len, = struct.unpack('<I', f.read(4))
+        header = json.loads(f.read(header_len))
+        history['sources'] = header['sources']
+        for name, code in HISTORY_COLUMNS.items():
+            column = history['columns'][name]
+            column.frombytes(f.read(header['rows'] * column.itemsize))
+            if header['byteorder'] != sys.byteorder:
+                column.byteswap()
+    return history
+
+def save_history(history, path=HISTORY_FILE):
+    columns = history['columns']
+    header = json.dumps({
+        'rows': len(columns['hours']),
+        'sources': history['sources'],
+        'byteorder': sys.byteorder,
+    }).encode()
+
+    # Write to a temp file first so an interrupted run never corrupts the store
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(HISTORY_MAGIC + struct.pack('<I', len(header)) + header)
+        for name in HISTORY_COLUMNS:
+            f.write(columns[name].tobytes())
+    os.replace(tmp_path, path)
+
+def record_hours(history, week_start, week_end, hours, invoice_no, source):
+    """Add a week to the history, replacing the row for the same invoice and week on re-runs."""
+    if source not in history['sources']:
+        history['sources'].append(source)
+    row = {
+        'week_start': week_start.toordinal(),
+        'week_end': week_end.toordinal(),
+        'hours': float(hours),
+        'invoice_no': int(invoice_no),
+        'source': history['sources'].index(source),
+    }
+
+    columns = history['columns']
+    for i in range(len(columns['hours'])):
+        if columns['invoice_no'][i] == row['invoice_no'] and columns['week_start'][i] == row['week_start']:
+            for name, value in row.items():
+                columns[name][i] = value
+            return
+    for name, value in row.items():
+        columns[name].append(value)
+
+def summarise_history(history, z_threshold=2.0):
+    """Totals, per-month sums and anomalous weeks, computed in one pass over the columns."""
+    columns = history['columns']
+    hours = columns['hours']
+    if not hours:
+        return None
+
+    monthly = {}
+    for start, h in zip(columns['week_start'], hours):
+        month = date.fromordinal(start).strftime('%Y-%m')
+        monthly[month] = monthly.get(month, 0.0) + h
+
+    mean = statistics.fmean(hours)
+    stdev = statistics.pstdev(hours, mean)
+    # Weeks billed at the 40h fallback/default or on an unvalidated model answer need a second look
+    suspect = {i for i, source in enumerate(history['sources'])
+               if source in ('fallback', 'default') or source.endswith(':unvalidated')}
+    anomalies = [
+        i for i, h in enumerate(hours)
+        if (stdev and abs(h - mean) / stdev > z_threshold) or columns['source'][i] in suspect
+    ]
+
+    return {
+        'weeks': len(hours),
+        'invoices': len(set(columns['invoice_no'])),
+        'total_hours': sum(hours),
+        'mean_hours': mean,
+        'monthly': dict(sorted(monthly.items())),
+        'anomalies': anomalies,
+    }
+
+@command('report')
+async def report():
+    start = time.perf_counter()
+    history = load_history()
+    summary = summarise_history(history)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    if summary is None:
+        print(f"No hours recorded yet in '{HISTORY_FILE}'")
+        return
+
+    print(f"Weeks: {summary['weeks']}  Invoices: {summary['invoices']}")
+    print(f"Total hours: {summary['total_hours']:.2f}  (mean {summary['mean_hours']:.2f}/week)")
+    print("\nHours per month:")
+    for month, total in summary['monthly'].items():
+        print(f"  {month}  {total:8.2f}")
+
+    columns = history['columns']
+    print(f"\nAnomalies: {len(summary['anomalies'])}")
+    for i in summary['anomalies']:
+        week_start = date.fromordinal(columns['week_start'][i])
+        week_end = date.fromordinal(columns['week_end'][i])
+        source = history['sources'][columns['source'][i]]
+        print(f"  Invoice #{columns['invoice_no'][i]}  {week_start} - {week_end}  "
+              f"{columns['hours'][i]:.2f} h  ({source})")
+
+    print(f"\nReport computed in {elapsed:.1f} ms")
+
+    if os.path.exists(CASCADE_STATS_FILE):
+        with open(CASCADE_STATS_FILE) as f:
+            stats = json.load(f)
+        print("\nHours extraction tiers:")
+        for model, tier in stats.items():
+            rates = "  ".join(f"{tier.get(outcome, 0) / tier['calls']:6.1%} {outcome}"
+                              for outcome in CASCADE_OUTCOMES)
+            print(f"  {model:<20} {tier['calls']:4d} calls  "
+                  f"{tier['seconds'] / tier['calls']:6.1f} s avg  {rates}")
+
+@command('main')
+async def main():
     # --skip-screenshot
     args = sys.argv[1:]
     skip_screenshot = "--skip-screenshot" in args
     
-    # date -> (subject, html)
+    _run_cancelled.clear()
+
+    # Work out the next invoice tab while the thread list loads; the tab itself
+    # is only created once all its data is known
+    spreadsheet_id = SPREADSHEET_ID
+    thread_ids, invoice_tab = await asyncio.gather(
+        latest_summary_threads(), plan_invoice_tab(spreadsheet_id)
+    )
+
+    async def fetch_email(tid):
+        # The subject (for the filename) comes with the HTML in the same request
+        subject, html = await get_thread_email(tid)
+        return tid, html, subject
+
+    # week -> (subject, html)
     email_map = []
     
-    for tid in latest_summary_threads():
-        html = get_thread_html(tid)
-        
+    for tid, html, subject in await asyncio.gather(*(fetch_email(tid) for tid in thread_ids)):
         if not html:
             print(f"[!] No HTML part found in thread {tid}"); continue
             
-        # Get the subject for the filename
-        subject = get_thread_subject(tid)
-        date = subject.replace("Weekly timesheet summary for ", "")
+        week = subject.replace("Weekly timesheet summary for ", "")
 
-        email_map.append((date, (subject, html)))
+        email_map.append((week, (subject, html)))
     
     # Ensure there are at least two weeks to compare
     if len(email_map) < 2:
         raise ValueError("Not enough data to determine folder name. At least two weeks are required.")
     
-    # Duplicate invoice tab
-    spreadsheet_id = "1ejsCfqnt_2-taD_uyTBnjF5u92sBd_RWoSmRkjgkTnE"
-    new_invoice_title = duplicate_invoice_tab(spreadsheet_id)
-    print(f"Duplicated invoice tab: {new_invoice_title}")
+    new_invoice_title = invoice_tab['title']
+    print(f"Next invoice tab: {new_invoice_title}")
     
     # Extract invoice number from the title - this will be our folder name
     invoice_no = new_invoice_title.split('#')[1].strip() if '#' in new_invoice_title else ""
 
     base_folder = "invoices"
-
-    os.makedirs(base_folder, exist_ok=True)
-    
     folder_name = f"{base_folder}/{new_invoice_title}"
-    
-    # Create folder
-    print(f"Creating folder: {folder_name}")
-    os.makedirs(folder_name, exist_ok=True)
+
+    # Render into a staging folder; the invoice folder only appears once its tab
+    # exists, so an aborted run never leaves a folder create_draft_for_latest_invoice
+    # would mistake for the newest invoice
+    staging_folder = tempfile.mkdtemp(prefix='invoice-')
     
     # Helper functions for date parsing
-    def month_to_num(month_abbr):
-        months = {
-            'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
-            'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
-        }
-        return months.get(month_abbr, 0)
-    
     def parse_date(date_str):
         parts = date_str.split()
         if len(parts) >= 2:
@@ -583,7 +1193,7 @@ def main():
     
     # Extract week dates from email subjects
     week_dates = []
-    for date, (subject, _) in email_map:
+    for week, (subject, _) in email_map:
         if "Weekly timesheet summary for " in subject:
             week_range = subject.replace("Weekly timesheet summary for ", "")
             week_dates.append(week_range)
@@ -619,39 +1229,20 @@ def main():
         overall_date_range = week_dates[0]
     
     # Calculate submission date (2 days after the last day of latest timesheet)
-    from datetime import datetime, timedelta
-    
     submission_date = None
     if week_dates:
         latest_week_range = week_dates[-1]  # Get the latest week range
         
-        # Extract the end date (e.g., from "Apr 11 - 17" get "17")
-        range_parts = latest_week_range.split(" - ")
-        if len(range_parts) == 2:
-            start_part, end_part = range_parts
-            
-            # Handle case where end date might include month (e.g., "Apr 25 - May 1")
-            if " " in end_part:  # End has month name (e.g., "May 1")
-                end_month, end_day = end_part.split(" ", 1)
-                end_month_num = month_to_num(end_month)
-                end_day_num = int(end_day)
-            else:  # End is just a day number (e.g., "17")
-                # Use month from start date
-                start_parts = start_part.split(" ")
-                end_month = start_parts[0]  # Get month from start date (e.g., "Apr")
-                end_month_num = month_to_num(end_month)
-                end_day_num = int(end_part)
-            
-            # Get current year
-            current_year = datetime.now().year
-            
-            # Create datetime object for end date
-            end_date = datetime(current_year, end_month_num, end_day_num)
+        if len(latest_week_range.split(" - ")) == 2:
+            # The subject has no year: use the latest year in which this week had started,
+            # so a run in early January still dates a December week to the previous year
+            _, week_end = infer_week_dates(latest_week_range, datetime.now().date())
+            end_date = datetime(week_end.year, week_end.month, week_end.day)
             
             # Add 2 days for submission date
             submission_date = end_date + timedelta(days=2)
             submission_date_str = submission_date.strftime("%m/%d/%Y")
-            print(f"Calculated submission date: {submission_date_str} (2 days after {end_month} {end_day_num})")
+            print(f"Calculated submission date: {submission_date_str} (2 days after {week_end:%b} {week_end.day})")
     
     # If submission date couldn't be calculated, fall back to current date
     if not submission_date:
@@ -659,26 +1250,67 @@ def main():
         submission_date_str = submission_date.strftime("%m/%d/%Y")
         print(f"Using current date for submission: {submission_date_str}")
     
-    # Save timesheet screenshots in the folder
+    # Errors that sank the run, in the order they happened (not weeks cancelled because of them)
+    week_failures = []
+
+    def fail_week(week, stage, e):
+        if _run_cancelled.is_set():
+            print(f"[!] {stage} for {week} cancelled")
+        else:
+            print(f"[!] {stage} for {week} failed: {str(e) or type(e).__name__}")
+            week_failures.append(e)
+            _run_cancelled.set()  # stop the other weeks at their next blocking call
+
+    async def process_week(week, html):
+        # Screenshot and hours extraction are blocking, so run them in worker threads.
+        # Each gets an absolute stage deadline that every call inside it respects,
+        # so one slow week fails fast instead of stalling the run
+        try:
+            image_path = await asyncio.to_thread(
+                html_to_png, html, staging_folder, f"{week}.png", driver_path, stage_deadline('screenshot')
+            )
+        except Exception as e:
+            # No screenshot means no invoice
+            fail_week(week, "Screenshot", e)
+            raise
+        try:
+            hours, source = await asyncio.to_thread(extract_hours, image_path, stage_deadline('hours'))
+            print(f"Extracted {hours} hours from {week}")
+        except TimeoutError as e:
+            # Never bill a made-up figure for a week we ran out of time on
+            fail_week(week, "Hours extraction", e)
+            raise
+        except Exception as e:
+            print(f"Error extracting hours from {week}: {str(e)}")
+            hours = 40.0  # fallback to 40.0 hours
+            source = 'fallback'
+        return week, image_path, hours, source
+
+    # Save timesheet screenshots in the folder and extract hours, all weeks at once
     timesheet_images = {}
-    for date, (subject, html) in email_map:
-        filename = f"{date}.png"
-        if not skip_screenshot:
-            image_path = html_to_png(html, folder_name, filename)
-            timesheet_images[date] = image_path
-    
-    # Extract hours from timesheet images
     week_hours = {}
-    if not skip_screenshot and timesheet_images:
-        print("Extracting hours from timesheet images...")
-        for date, image_path in timesheet_images.items():
-            try:
-                hours = get_total_hours(image_path)
-                week_hours[date] = hours
-                print(f"Extracted {hours} hours from {date}")
-            except Exception as e:
-                print(f"Error extracting hours from {date}: {str(e)}")
-                week_hours[date] = 40.0  # fallback to 40.0 hours
+    week_sources = {}
+    if not skip_screenshot:
+        # Install the driver before the weeks run in parallel, so they don't race on the download
+        driver_path = await asyncio.to_thread(install_chromedriver, stage_deadline('screenshot'))
+        print("Rendering timesheets and extracting hours...")
+        try:
+            # Wait for every week, so a failed run has no worker threads left
+            # running once it reports; the cancel event makes that wait short
+            weeks = await asyncio.gather(
+                *(process_week(week, html) for week, (_, html) in email_map), return_exceptions=True
+            )
+            errors = [w for w in weeks if isinstance(w, BaseException)]
+            if errors:
+                raise (week_failures or errors)[0]
+        except BaseException:
+            _run_cancelled.set()
+            shutil.rmtree(staging_folder, ignore_errors=True)
+            raise
+        for week, image_path, hours, source in weeks:
+            timesheet_images[week] = image_path
+            week_hours[week] = hours
+            week_sources[week] = source
     
     # Map hours to weeks in chronological order
     sorted_weeks = sorted(week_hours.keys(), key=lambda date_range: parse_date(date_range.split(" - ")[0]))
@@ -700,20 +1332,31 @@ def main():
     elif len(week_dates) == 1:
         sheet_data['week_one_date'] = week_dates[0]
     
-    # Update the sheet with the data
-    set_sheet_data(spreadsheet_id, new_invoice_title, sheet_data)
+    # Create the invoice tab with the data in one write
+    try:
+        await duplicate_invoice_tab(spreadsheet_id, invoice_tab, sheet_data)
+    except BaseException:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+        raise
     print(f"Updated invoice {invoice_no} with dates: {', '.join(week_dates)} and hours: {week_one_hours}, {week_two_hours}")
 
+    # The tab exists now, so move the screenshots into the invoice folder
+    print(f"Creating folder: {folder_name}")
+    os.makedirs(folder_name, exist_ok=True)
+    for week, image_path in timesheet_images.items():
+        timesheet_images[week] = shutil.move(image_path, os.path.join(folder_name, os.path.basename(image_path)))
+    shutil.rmtree(staging_folder, ignore_errors=True)
+
     # Save the PDF to the sheet (using same name as folder)
     pdf_filename = f"{new_invoice_title}.pdf"
     pdf_path = os.path.join(folder_name, pdf_filename)
-    save_pdf_to_sheet(spreadsheet_id, new_invoice_title, pdf_path)
+    await save_pdf_to_sheet(spreadsheet_id, new_invoice_title, pdf_path)
     print(f"PDF saved to: {pdf_path}")
     
     # Create email draft with attachments
     if overall_date_range and not skip_screenshot:
         print("\nCreating email draft...")
-        draft_id = create_email_draft(
+        draft_id = await create_email_draft(
             invoice_no=invoice_no,
             date_range=overall_date_range,
             pdf_path=pdf_path,
@@ -726,7 +1369,22 @@ def main():
     else:
         print("Skipping email draft creation (missing date range or screenshots skipped)")
 
-def create_draft_for_latest_invoice():
+    # Keep a local record of what was invoiced for the report command. Weeks are
+    # dated relative to the invoiced period, not today; a failure here must not
+    # affect the invoice, which is already complete
+    try:
+        period_end = submission_date.date() if week_dates else datetime.now().date()
+        history = load_history()
+        for week_range, hours in zip(week_dates, [week_one_hours, week_two_hours]):
+            week_start, week_end = infer_week_dates(week_range, period_end)
+            record_hours(history, week_start, week_end, hours, invoice_no,
+                         week_sources.get(week_range, 'default'))
+        save_history(history)
+    except Exception as e:
+        print(f"[!] Could not record hours history: {str(e)}")
+
+@command('create_draft_for_latest_invoice')
+async def create_draft_for_latest_invoice():
     invoices_folder = "invoices"
     
     # Check if invoices folder exists
@@ -755,6 +1413,12 @@ def create_draft_for_latest_invoice():
         print("Could not extract invoice number from folder name")
         return
     
+    # With --refresh-pdf, re-export the invoice tab first; this is a single
+    # metadata check when the tab hasn't changed since the last export
+    if "--refresh-pdf" in sys.argv[1:]:
+        refreshed_pdf = os.path.join(latest_invoice_path, f"{latest_invoice}.pdf")
+        await save_pdf_to_sheet(SPREADSHEET_ID, latest_invoice, refreshed_pdf)
+
     # Find PDF file in the folder
     pdf_files = [f for f in os.listdir(latest_invoice_path) if f.endswith('.pdf')]
     if not pdf_files:
@@ -781,13 +1445,6 @@ def create_draft_for_latest_invoice():
         return
     
     # Helper functions for date parsing (same as in main())
-    def month_to_num(month_abbr):
-        months = {
-            'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
-            'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12
-        }
-        return months.get(month_abbr, 0)
-    
     def parse_date(date_str):
         parts = date_str.split()
         if len(parts) >= 2:
@@ -834,7 +1491,7 @@ def create_draft_for_latest_invoice():
     
     # Create email draft
     print(f"\nCreating email draft for Invoice #{invoice_no}...")
-    draft_id = create_email_draft(
+    draft_id = await create_email_draft(
         invoice_no=invoice_no,
         date_range=overall_date_range,
         pdf_path=pdf_path,
@@ -847,18 +1504,38 @@ def create_draft_for_latest_invoice():
         print(f"Attachments: {len(timesheet_images) + 1} files (1 PDF + {len(timesheet_images)} timesheets)")
     else:
         print("Failed to create email draft")
+
 if __name__ == '__main__':
     args = sys.argv[1:]
-    
-    commands = {
-        'create_draft_for_latest_invoice': create_draft_for_latest_invoice,
-        'main': main
-    }
-    
-    command = args[0] if args else 'main'
-    
-    if command in commands:
-        commands[command]()
+    show_timings = "--timings" in args
+
+    deadline = RUN_DEADLINE
+    for arg in args:
+        if arg.startswith("--deadline="):
+            try:
+                deadline = float(arg.split("=", 1)[1])
+            except ValueError:
+                deadline = math.nan
+            # nan would silently disable the deadline (min(x, nan) == x), so insist on a real budget
+            if not math.isfinite(deadline) or deadline <= 0:
+                print(f"Invalid deadline: {arg} (must be a positive number of seconds)")
+                print("Usage: python index.py [command] [--deadline=SECONDS] [--timings]")
+                sys.exit(2)
+
+    positional = [a for a in args if not a.startswith("--")]
+    name = positional[0] if positional else 'main'
+
+    if name in COMMANDS:
+        _deadline.set(time.monotonic() + deadline)
+        try:
+            with timed(f"command {name}"):
+                asyncio.run(COMMANDS[name]())
+        except TimeoutError as e:
+            print(f"[!] {name} aborted after hitting a time budget: {str(e) or 'stage timed out'}")
+            sys.exit(1)
+        finally:
+            if show_timings:
+                print_timings()
     else:
-        print(f"Unknown command: {command}")
-        print("Available commands:", list(commands.keys()))
+        print(f"Unknown command: {name}")
+        print("Available commands:", list(COMMANDS.keys()))